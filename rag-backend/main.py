@@ -1,3 +1,4 @@
+import asyncio
 import os
 import re
 import uuid
@@ -6,15 +7,18 @@ from typing import Optional, List, Dict, Any, Tuple
 from urllib.parse import quote
 import time
 import hmac
+from functools import lru_cache
 import hashlib
 import base64
 import json
+import orjson
 from fastapi import Depends, Header, Query
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel, Field
 
 from rag import RagPipeline
@@ -24,10 +28,15 @@ load_dotenv()
 PORT = int(os.getenv("PORT", "8000"))
 CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:5173").split(",") if o.strip()]
 DOCS_DIR = os.getenv("DOCS_DIR", "./docs")  # used by /api/files route
+# when set, skips per-request Starlette base_url assembly in citation links
+API_BASE = os.getenv("API_BASE", "").rstrip("/") or None
 JWT_SECRET = os.getenv("PATHWAY_RAG_JWT_SECRET", "")
 JWT_REQUIRED_CAP = os.getenv("JWT_REQUIRED_CAP", "edit_posts")
+REDIS_URL = os.getenv("REDIS_URL", "")
+CONV_TTL_SECONDS = int(os.getenv("CONV_TTL_SECONDS", "86400"))
 
-app = FastAPI(title="RAG Backend", version="0.1.0")
+# orjson serializes responses several times faster than the stdlib encoder
+app = FastAPI(title="RAG Backend", version="0.1.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,12 +46,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# simple in-memory conversations (replace with redis/db for prod)
-CONV: Dict[str, List[Dict[str, Any]]] = {}
+class ConvStore:
+    """
+    Append-only conversation history. With REDIS_URL set, turns are RPUSH'ed
+    to Redis (bounded memory per worker, shared across workers, TTL'd);
+    without it, falls back to a plain in-memory dict for local dev.
+    """
+
+    def __init__(self, url: str, ttl: int):
+        self._ttl = ttl
+        if url:
+            import redis.asyncio as aioredis
+            self._redis = aioredis.from_url(url)
+            self._local = None
+        else:
+            self._redis = None
+            self._local: Dict[str, List[Dict[str, Any]]] = {}
+
+    async def append(self, conv_id: str, message: Dict[str, Any]) -> None:
+        if self._redis is not None:
+            key = f"conv:{conv_id}"
+            await self._redis.rpush(key, orjson.dumps(message))
+            if self._ttl:
+                await self._redis.expire(key, self._ttl)
+        else:
+            self._local.setdefault(conv_id, []).append(message)
+
+
+CONV = ConvStore(REDIS_URL, CONV_TTL_SECONDS)
 
 # init pipeline
 PIPE = RagPipeline.from_disk()
 
+# parse the extension maps once at startup instead of on the first request
+mimetypes.init()
+
+
+@lru_cache(maxsize=2048)
+def _file_meta(safe: str) -> Optional[Tuple[str, str]]:
+    """
+    Resolve a (path, media_type) tuple for a file in DOCS_DIR, or None if it
+    does not exist. Cached per filename; cleared on upload/reload since those
+    are the only ways the docs dir changes.
+    """
+    path = os.path.join(DOCS_DIR, safe)
+    if not os.path.isfile(path):
+        return None
+    mime_type, _ = mimetypes.guess_type(path)
+    return path, mime_type or "application/octet-stream"
+
 
 # ---------- models ----------
 class ChatIn(BaseModel):
@@ -130,15 +182,22 @@ def health():
 
 
 @app.post("/api/reload")
-def reload_index(user=Depends(require_auth)):
-    PIPE.reload()
-    return {"status": "reloaded"}
+async def reload_index(full: bool = Query(default=False), user=Depends(require_auth)):
+    # incremental by default (only changed files re-embed); ?full=true rebuilds
+    await asyncio.to_thread(PIPE.reload, full)
+    _file_meta.cache_clear()
+    return {"status": "reloaded", "full": full}
 
 
 # ---------- helpers ----------
-def _basename_from_path(p: str) -> str:
-    p = p.replace("\\", "/")
-    return os.path.basename(p)
+# the same few PDF filenames repeat across chats; cache their percent-encoding
+_quote_filename = lru_cache(maxsize=4096)(quote)
+
+
+def _filename_from_url(url: str) -> str:
+    # last path component, tolerating either separator, without the
+    # intermediate replace("\\", "/") copy a basename() round trip needs
+    return url.rsplit("/", 1)[-1].rsplit("\\", 1)[-1]
 
 
 def _normalize_citations_with_map(
@@ -154,7 +213,7 @@ def _normalize_citations_with_map(
     out: List[Dict[str, str]] = []
     seen_by_key: Dict[str, int] = {}   # key -> new_index (1-based)
     old_to_new: Dict[int, int] = {}
-    base = str(request.base_url).rstrip("/")  # e.g., http://127.0.0.1:8000
+    base = API_BASE or str(request.base_url).rstrip("/")  # e.g., http://127.0.0.1:8000
 
     for idx, c in enumerate(citations or [], start=1):  # idx is 1-based
         url = c.get("url") or ""
@@ -162,11 +221,10 @@ def _normalize_citations_with_map(
         filename: Optional[str] = None
 
         if url.startswith("file://"):
-            cleaned = url.replace("file://", "")
-            filename = _basename_from_path(cleaned)
+            filename = _filename_from_url(url.removeprefix("file://"))
         elif url and not url.startswith("http"):
             # tolerate raw filenames
-            filename = _basename_from_path(url)
+            filename = _filename_from_url(url)
 
         # Stable dedupe key: prefer filename; then title; then url
         key = (filename or (title or "") or url).strip().lower()
@@ -176,7 +234,7 @@ def _normalize_citations_with_map(
         # First time we see this key -> add it
         if key not in seen_by_key:
             if filename:
-                normalized_url = f"{base}/api/files/{quote(filename)}"
+                normalized_url = f"{base}/api/files/{_quote_filename(filename)}"
                 out.append({"title": title or filename, "url": normalized_url})
             else:
                 out.append({"title": title, "url": url})
@@ -187,8 +245,8 @@ def _normalize_citations_with_map(
     return out, old_to_new
 
 
-_num_pat_round = re.compile(r"\((\d+)\)")
-_num_pat_square = re.compile(r"\[(\d+)\]")
+# single alternation so (n) and [n] markers are rewritten in one pass
+_num_pat = re.compile(r"\((\d+)\)|\[(\d+)\]")
 
 
 def _renumber_answer_markers(text: str, old_to_new: Dict[int, int]) -> str:
@@ -196,37 +254,80 @@ def _renumber_answer_markers(text: str, old_to_new: Dict[int, int]) -> str:
     Replace (n) and [n] markers with remapped numbers based on old_to_new.
     Unknown numbers are left as-is.
     """
+    remap = old_to_new.get
 
-    def repl_round(m: re.Match):
-        n = int(m.group(1))
-        return f"({old_to_new.get(n, n)})"
+    def repl(m: re.Match):
+        if m.group(1) is not None:
+            n = int(m.group(1))
+            return f"({remap(n, n)})"
+        n = int(m.group(2))
+        return f"[{remap(n, n)}]"
 
-    def repl_square(m: re.Match):
-        n = int(m.group(1))
-        return f"[{old_to_new.get(n, n)}]"
-
-    text = _num_pat_round.sub(repl_round, text)
-    text = _num_pat_square.sub(repl_square, text)
-    return text
+    return _num_pat.sub(repl, text)
 # ----------------------------
 
 
 @app.post("/api/chat", response_model=ChatOut)
-def chat(body: ChatIn, request: Request):
+async def chat(body: ChatIn, request: Request):
     conv_id = body.conversation_id or f"conv-{uuid.uuid4().hex[:8]}"
-    history = CONV.setdefault(conv_id, [])
-    history.append({"role": "user", "content": body.query})
+    await CONV.append(conv_id, {"role": "user", "content": body.query})
 
-    answer, citations = PIPE.answer(body.query)
+    # PIPE.answer blocks on the embeddings + LLM round trips; offload it so the
+    # event loop can keep serving other requests. The cheap citation cleanup
+    # below stays on the loop.
+    answer, citations = await asyncio.to_thread(PIPE.answer, body.query)
 
     # Normalize + dedupe + renumber
     norm_citations, old_to_new = _normalize_citations_with_map(citations, request)
     answer = _renumber_answer_markers(answer, old_to_new)
 
-    history.append({"role": "assistant", "content": answer, "citations": norm_citations})
+    await CONV.append(conv_id, {"role": "assistant", "content": answer, "citations": norm_citations})
     return ChatOut(answer=answer, citations=norm_citations, conversation_id=conv_id)
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(body: ChatIn, request: Request):
+    """
+    SSE variant of /api/chat: emits `data: {"delta": ...}` events as LLM
+    tokens arrive, then a final event with the normalized citations and
+    conversation id, then `data: [DONE]`. Time-to-first-token drops from
+    full-answer latency to roughly the retrieval cost.
+    """
+    conv_id = body.conversation_id or f"conv-{uuid.uuid4().hex[:8]}"
+    await CONV.append(conv_id, {"role": "user", "content": body.query})
+
+    async def events():
+        parts: List[str] = []
+        citations: List[Dict[str, str]] = []
+        # PIPE.stream_answer is a blocking generator; iterate it off the loop
+        async for kind, payload in iterate_in_threadpool(PIPE.stream_answer(body.query)):
+            if kind == "delta":
+                parts.append(payload)
+                yield f"data: {orjson.dumps({'delta': payload}).decode()}\n\n"
+            else:
+                citations = payload
+
+        answer = "".join(parts)
+        norm_citations, old_to_new = _normalize_citations_with_map(citations, request)
+        answer = _renumber_answer_markers(answer, old_to_new)
+        await CONV.append(conv_id, {"role": "assistant", "content": answer, "citations": norm_citations})
+        # the [n] markers already streamed used the raw numbering; ship the
+        # old->new mapping so the client can remap them to norm_citations
+        final = {
+            "citations": norm_citations,
+            "citation_map": {str(k): v for k, v in old_to_new.items()},
+            "conversation_id": conv_id,
+        }
+        yield f"data: {orjson.dumps(final).decode()}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 @app.get("/api/files/{name}")
 def get_file(name: str, user=Depends(require_auth_from_header_or_query)):
     """
@@ -236,15 +337,11 @@ def get_file(name: str, user=Depends(require_auth_from_header_or_query)):
     - Guesses MIME type for other files for correct preview/download behavior.
     """
     safe = os.path.basename(name)  # prevent ../../ tricks
-    path = os.path.join(DOCS_DIR, safe)
 
-    if not os.path.isfile(path):
+    meta = _file_meta(safe)
+    if meta is None:
         raise HTTPException(status_code=404, detail="File not found")
-
-    # Guess MIME type
-    mime_type, _ = mimetypes.guess_type(path)
-    if mime_type is None:
-        mime_type = "application/octet-stream"
+    path, mime_type = meta
 
     # Use inline disposition for PDFs so browser viewers honor #page=N anchors
     headers = {}
@@ -259,9 +356,10 @@ def get_file(name: str, user=Depends(require_auth_from_header_or_query)):
 # main.py (replace only the /api/upload route and add a small env at top)
 
 MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "50"))  # optional soft guard
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
 
 @app.post("/api/ask", response_model=ChatOut)
-def ask(body: ChatIn, request: Request, user=Depends(require_auth)):
+async def ask(body: ChatIn, request: Request, user=Depends(require_auth)):
     """
     Accepts:
       - query: user question
@@ -270,16 +368,12 @@ def ask(body: ChatIn, request: Request, user=Depends(require_auth)):
     """
     conv_id = body.conversation_id or f"conv-{uuid.uuid4().hex[:8]}"
 
-    # 🧠 Get the conversation memory if exists, otherwise new
-    history = CONV.setdefault(conv_id, [])
-    history.append({"role": "user", "content": body.query})
+    # 🧠 Record the user turn in the conversation store
+    await CONV.append(conv_id, {"role": "user", "content": body.query})
 
     # 🧠 Combine the history into a contextual prompt (last few turns only)
     history_text = ""
-    if isinstance(body, dict):
-        hist = body.get("history", [])
-    else:
-        hist = getattr(body, "history", None) or []
+    hist = body.history or []
     if hist and isinstance(hist, list):
         recent = hist[-6:]  # limit to last few to stay within token limits
         history_text = "\n".join(
@@ -293,15 +387,15 @@ def ask(body: ChatIn, request: Request, user=Depends(require_auth)):
     else:
         query_with_history = body.query
 
-    # 🧠 Generate the RAG answer
-    answer, citations = PIPE.answer(query_with_history)
+    # 🧠 Generate the RAG answer (blocking call, run off the event loop)
+    answer, citations = await asyncio.to_thread(PIPE.answer, query_with_history)
 
     # Normalize and map citations
     norm_citations, old_to_new = _normalize_citations_with_map(citations, request)
     answer = _renumber_answer_markers(answer, old_to_new)
 
     # Store in conversation memory
-    history.append({
+    await CONV.append(conv_id, {
         "role": "assistant",
         "content": answer,
         "citations": norm_citations
@@ -318,29 +412,34 @@ async def upload(file: UploadFile = File(...), user=Depends(require_auth)):
     os.makedirs(DOCS_DIR, exist_ok=True)
     dest = os.path.join(DOCS_DIR, os.path.basename(file.filename))
 
+    # Stream to disk chunk-by-chunk so memory stays bounded at UPLOAD_CHUNK_SIZE
+    # regardless of the upload size; never buffer the whole file.
     size = 0
-    chunk_size = 1024 * 1024  # 1MB
     try:
         with open(dest, "wb") as f:
             while True:
-                chunk = await file.read(chunk_size)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
                 if not chunk:
                     break
                 size += len(chunk)
                 if MAX_UPLOAD_MB and size > MAX_UPLOAD_MB * 1024 * 1024:
-                    # Clean up partial file and abort
-                    f.close()
-                    try:
-                        os.remove(dest)
-                    except Exception:
-                        pass
                     raise HTTPException(status_code=413, detail="File too large")
                 f.write(chunk)
-    except HTTPException:
-        raise
-    except Exception as e:
+    except BaseException as e:
+        # Clean up the partial file on any failure (size limit, disk error, disconnect)
+        try:
+            os.remove(dest)
+        except OSError:
+            pass
+        # a client disconnect surfaces as CancelledError; cancellation (and
+        # other non-Exception failures) must propagate, not become a 500
+        if isinstance(e, HTTPException) or not isinstance(e, Exception):
+            raise
         raise HTTPException(status_code=500, detail=f"Failed to save: {e!s}")
 
+    # New file in DOCS_DIR: forget any cached "missing"/stale metadata for it
+    _file_meta.cache_clear()
+
     # Reload the vector index after successful upload
     try:
         PIPE.reload()
@@ -1,19 +1,32 @@
-import os, uuid, glob, html
-from typing import List, Tuple, Optional, Dict
-from dataclasses import dataclass
+import os, uuid
+import hashlib
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, List, Tuple, Optional, Dict
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
 import re
 
 from dotenv import load_dotenv
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain.schema import Document
-from langchain_community.document_loaders import TextLoader, BSHTMLLoader, PyPDFLoader
+from langchain_community.document_loaders import TextLoader, BSHTMLLoader, PyMuPDFLoader
 
 # LLM + embeddings (OpenAI or Ollama)
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 from urllib.parse import quote
 
+try:
+    import ahocorasick  # optional: one-pass multi-keyword scanning (perf extra)
+except ImportError:
+    ahocorasick = None
+
 load_dotenv()
 
 # ------- config -------
@@ -33,144 +46,628 @@ OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-s
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1")
 OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
 
+# Local in-process embeddings (EMBED_PROVIDER=local; needs the local-embed extra)
+EMBED_PROVIDER = os.getenv("EMBED_PROVIDER", "").lower()
+ONNX_EMBED_MODEL = os.getenv("ONNX_EMBED_MODEL", "./models/bge-small-en-int8.onnx")
+ONNX_EMBED_TOKENIZER = os.getenv("ONNX_EMBED_TOKENIZER", "./models/tokenizer.json")
+
+# Batch size for embedding documents at index build (OpenAI allows large
+# batches; raise or lower to match API tier limits)
+EMBED_DOC_BATCH = int(os.getenv("EMBED_DOC_BATCH", "512"))
+
+# Query-embedding micro-batching (set EMBED_MAX_BATCH=1 to disable)
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "16"))
+EMBED_BATCH_WAIT_MS = int(os.getenv("EMBED_BATCH_WAIT_MS", "15"))
+
+# Answer cache (set ANSWER_CACHE_SIZE=0 to disable)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+
+# Semantic cache: reuse answers for near-duplicate queries by embedding
+# similarity (set SEMANTIC_CACHE_SIZE=0 to disable)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+
+# inline [n] citation markers in LLM answers; compiled once, reused everywhere
+_CITE_PAT = re.compile(r"\[(\d+)\]")
+
+# hot-path patterns, compiled once at import instead of per call (the re
+# module cache still costs a lookup per invocation)
+_WS_PAT = re.compile(r"\s+")
+_TOKEN_PAT = re.compile(r"[a-zA-Z][a-zA-Z\-']{2,}")
+_FOOTNOTE_PAT = re.compile(
+    r"(?:\bwww\.[^\s]+|\bhttps?://[^\s]+|\baccessed\s+\w+|\bvol\.\s*\d+|\bp\.\s*\d+|\bdoi:)",
+    re.I
+)
+_JUNK_PAT = re.compile(r"(table of contents|copyright|all rights reserved|printed on)")
+# short chunks get the junk and footnote tests in one engine entry
+_JUNK_OR_FOOTNOTE_PAT = re.compile(
+    f"{_JUNK_PAT.pattern}|{_FOOTNOTE_PAT.pattern}", re.I
+)
+_NUMBERED_ITEM_PAT = re.compile(r"(?m)^(\d+)\.")
+_EXPECTED_COUNT_PAT = re.compile(r"\b(\d{1,2})\b.*(truth|commandment|beatitude|article|tenet)", re.I)
+_DUP_CITE_PAT = re.compile(r"(\[\d+\])(?:\1)+")
+_FACTUAL_PAT = re.compile(r"(\bthe\b|\d+\.|•|- )", re.I)
+_SENT_SPLIT_PAT = re.compile(r"(?<=[.!?])\s+")
+_APOLOGY_PAT = re.compile(r"sorry|cannot|insufficient|not enough", re.I)
+
+# Phrases that mean the model gave up or the answer is incomplete. Compiled
+# into single case-insensitive alternations so each check is one pass over
+# the answer with no lowercased copy (the re engine runs these as one scan,
+# unlike a per-phrase `in` loop which rescans the text K times).
+_REFUSAL_PAT = re.compile(
+    "|".join(re.escape(p) for p in (
+        "cannot answer",
+        "insufficient context",
+        "not enough information",
+        "no relevant information",
+        "based on the provided context i cannot",
+        "sorry, we do not have enough information",
+        "my main purpose here is to answer information questions from the file base",
+    )),
+    re.IGNORECASE,
+)
+_RETRY_TRIGGER_PAT = re.compile(
+    "|".join(re.escape(p) for p in (
+        "sorry, we do not have enough information",
+        "insufficient context",
+        "not enough information",
+        "cannot answer",
+        "no relevant information",
+        "list may not be complete",
+        "appears to be truncated",
+        "context does not include all items",
+    )),
+    re.IGNORECASE,
+)
+
 STOPWORDS = {
     "the","a","an","of","and","or","to","in","on","for","with","as","by","is","are",
     "be","that","this","it","its","at","from","about","into","over","under","between",
     "without","within","their","his","her","our","your","my","we","you","they"
 }
 
-def _basename(doc: Document) -> str:
-    src = (doc.metadata or {}).get("source", "") or ""
-    return os.path.basename(src)
-
 def _normalize(s: str) -> str:
-    return re.sub(r"\s+", " ", s or "").strip().lower()
+    return _WS_PAT.sub(" ", s or "").strip().lower()
 
 def _query_keywords(q: str) -> List[str]:
     # simple, universal keyword extractor
-    toks = re.findall(r"[a-zA-Z][a-zA-Z\-']{2,}", q.lower())
+    toks = _TOKEN_PAT.findall(q.lower())
     return [t for t in toks if t not in STOPWORDS]
 
-def _hits(text: str, kws: List[str]) -> int:
-    t = _normalize(text)
-    return sum(1 for k in kws if k in t)
-
-def _majority_source(docs: List[Document]) -> Optional[str]:
-    if not docs:
-        return None
-    counts: Dict[str, int] = {}
-    for d in docs:
-        b = _basename(d)
-        counts[b] = counts.get(b, 0) + 1
-    # pick the basename that appears most
-    return max(counts, key=counts.get)
-
-def iterative_retrieve(self, query: str, k: int = TOP_K, max_passes: int = 3) -> List[Document]:
+def _keyword_counter(kws: List[str]):
     """
-    Attempt multi-pass retrieval when the first batch might be incomplete.
-    Each pass excludes previously seen sources/pages.
+    Build a callable that counts how many distinct query keywords occur in a
+    (lowercased) text. With pyahocorasick installed the text is scanned once
+    for all keywords; otherwise each keyword is a separate substring scan.
     """
-    all_docs = []
-    seen_keys = set()
+    if ahocorasick is not None and kws:
+        automaton = ahocorasick.Automaton()
+        for kw in kws:
+            automaton.add_word(kw, kw)
+        automaton.make_automaton()
+        total = len(kws)
+
+        def count(low: str) -> int:
+            found = set()
+            for _, kw in automaton.iter(low):
+                found.add(kw)
+                if len(found) == total:
+                    break
+            return len(found)
 
-    for pass_i in range(max_passes):
-        # Retrieve as usual
-        new_docs = self.retrieve(query, k=k)
+        return count
 
-        # Filter out duplicates (same source + page)
-        unique = []
-        for d in new_docs:
-            key = (d.metadata.get("source"), d.metadata.get("page"))
-            if key not in seen_keys:
-                seen_keys.add(key)
-                unique.append(d)
+    def count(low: str) -> int:
+        return sum(1 for k in kws if k in low)
 
-        # Stop if we are not finding anything new
-        if not unique:
-            break
+    return count
 
-        all_docs.extend(unique)
-
-        # 🔍 If the retrieved docs already cover many unique sections (e.g. 10+ chunks), stop early
-        if len(all_docs) >= k * 2:
-            break
+def _majority_source(basenames) -> Optional[str]:
+    # C-accelerated count + single heap pass instead of a hand-rolled dict
+    counts = Counter(basenames)
+    if not counts:
+        return None
+    return counts.most_common(1)[0][0]
+
+@dataclass(slots=True)
+class _Candidate:
+    """Per-document scratch state for retrieve(): the lowercase text,
+    basename and page are computed once here and reused by every stage."""
+    doc: Document
+    low: str
+    base: str
+    page: Optional[int]
+    score: int = 0
+
+# context.txt entries are appended by a single daemon thread so the answer
+# path only pays for a queue put, never for disk I/O
+_DEBUG_LOG_Q: "queue.Queue[bytes]" = queue.Queue()
+
+def _debug_log_worker() -> None:
+    while True:
+        payload = _DEBUG_LOG_Q.get()
+        try:
+            with open("context.txt", "ab") as f:
+                f.write(payload)
+        except Exception as e:
+            print(f"⚠️ Failed to write context.txt: {e}")
 
-    # Limit to k final documents (you can choose len(all_docs) if you prefer to feed all)
-    return all_docs[:k]
+threading.Thread(target=_debug_log_worker, daemon=True).start()
 
+def _debug_log(entry: str) -> None:
+    _DEBUG_LOG_Q.put(entry.encode("utf-8"))
 
 # ------- helpers -------
-def _load_docs_from_dir(path: str) -> List[Document]:
-    docs: List[Document] = []
-    # load .md / .txt
-    for fp in glob.glob(os.path.join(path, "**", "*.md"), recursive=True) + \
-               glob.glob(os.path.join(path, "**", "*.txt"), recursive=True):
+_SUPPORTED_EXTS = (".md", ".txt", ".html", ".pdf")
+
+
+def _supported_files(path: str) -> List[str]:
+    # one os.walk pass instead of a recursive glob per extension, which
+    # would re-read every directory four times
+    files: List[str] = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in _SUPPORTED_EXTS:
+                files.append(os.path.join(root, name))
+    return files
+
+
+def _load_one_file(fp: str) -> List[Document]:
+    ext = os.path.splitext(fp)[1].lower()
+    if ext in (".md", ".txt"):
         loader = TextLoader(fp, encoding="utf-8")
-        for d in loader.load():
-            d.metadata["source"] = fp
-            docs.append(d)
-    # load .html
-    for fp in glob.glob(os.path.join(path, "**", "*.html"), recursive=True):
+    elif ext == ".html":
         loader = BSHTMLLoader(fp, open_encoding="utf-8")
+    elif ext == ".pdf":
+        # PyMuPDF extracts text far faster than pypdf and still yields one
+        # Document per page with the same page metadata
+        loader = PyMuPDFLoader(fp)
+    else:
+        return []
+    docs: List[Document] = []
+    try:
         for d in loader.load():
             d.metadata["source"] = fp
             docs.append(d)
-    # load .pdf
-    for fp in glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True):
-        try:
-            loader = PyPDFLoader(fp)
-            for d in loader.load():
-                d.metadata["source"] = fp
-                docs.append(d)
-        except Exception:
-            # skip unreadable pdfs; consider logging
-            continue
+    except Exception as e:
+        # skip unreadable files, but say so — this is the only signal when a
+        # native extractor (e.g. pymupdf) is missing from the environment
+        print(f"⚠️ Failed to load {fp}: {e}")
+        return []
     return docs
 
+
+def _load_docs_from_dir(path: str) -> List[Document]:
+    files = _supported_files(path)
+    if not files:
+        return []
+    # per-file loading is IO-bound (and pdf parsing mostly runs outside the
+    # GIL), so fan out across a thread pool; ex.map preserves file order
+    docs: List[Document] = []
+    max_workers = min(32, (os.cpu_count() or 4) * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for loaded in ex.map(_load_one_file, files):
+            docs.extend(loaded)
+    return docs
+
+
+# manifest: source path -> {"mtime": float, "ids": [chunk ids]}; lets reload()
+# re-embed only the files that actually changed since the last index build
+def _manifest_path() -> str:
+    return os.path.join(CHROMA_DIR, "manifest.json")
+
+
+def _load_manifest() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest: Dict[str, Dict[str, Any]]) -> None:
+    os.makedirs(CHROMA_DIR, exist_ok=True)
+    tmp = _manifest_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, _manifest_path())
+
+
+def _build_manifest(chunks: List[Document], ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    manifest: Dict[str, Dict[str, Any]] = {}
+    for chunk, cid in zip(chunks, ids):
+        src = chunk.metadata.get("source", "") or ""
+        entry = manifest.setdefault(src, {"mtime": 0.0, "ids": []})
+        entry["ids"].append(cid)
+    for src, entry in manifest.items():
+        try:
+            entry["mtime"] = os.path.getmtime(src)
+        except OSError:
+            pass
+    return manifest
+
+def _embed_chunks(embeddings, chunks: List[Document]) -> List[List[float]]:
+    """
+    Embed chunk texts with content-hash dedup: boilerplate repeated across
+    pages (headers, footers, cover text) is embedded once and its vector
+    reused, so the embedding API is only called for unique texts — in one
+    batched embed_documents() call.
+    """
+    seen: Dict[bytes, int] = {}
+    unique_texts: List[str] = []
+    keys: List[bytes] = []
+    for c in chunks:
+        h = hashlib.blake2b(c.page_content.encode("utf-8"), digest_size=16).digest()
+        if h not in seen:
+            seen[h] = len(unique_texts)
+            unique_texts.append(c.page_content)
+        keys.append(h)
+
+    vectors = embeddings.embed_documents(unique_texts) if unique_texts else []
+    if len(unique_texts) < len(chunks):
+        saved = len(chunks) - len(unique_texts)
+        print(f"⚙️ Embedded {len(unique_texts)} unique chunks for {len(chunks)} total "
+              f"(dedup skipped {saved}, {saved * 100 // len(chunks)}% of embedding calls)")
+    return [vectors[seen[h]] for h in keys]
+
+
+def _index_chunks(vectordb: Chroma, embeddings, chunks: List[Document], ids: List[str]) -> None:
+    if not chunks:
+        return
+    vectors = _embed_chunks(embeddings, chunks)
+    # add with precomputed vectors; langchain's add_documents would re-embed.
+    # insert in slices to stay under Chroma's max batch size on big corpora
+    for start in range(0, len(chunks), 1000):
+        batch = slice(start, start + 1000)
+        vectordb._collection.add(
+            ids=ids[batch],
+            embeddings=vectors[batch],
+            documents=[c.page_content for c in chunks[batch]],
+            metadatas=[c.metadata for c in chunks[batch]],
+        )
+
+
 def _split(docs: List[Document]) -> List[Document]:
     splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    return splitter.split_documents(docs)
+    chunks = splitter.split_documents(docs)
+    # strip once at index time so prompt building never has to re-strip
+    for c in chunks:
+        c.page_content = c.page_content.strip()
+    return chunks
+
+class LocalEmbeddings:
+    """
+    In-process sentence embeddings via an ONNX model (e.g. int8-quantized
+    bge-small-en). Replaces the ~100-300 ms HTTPS round trip per query
+    embedding with a few ms of local CPU; no per-query API cost.
+    Imports are deferred so the default OpenAI/Ollama paths do not need
+    onnxruntime installed.
+    """
+
+    def __init__(self, model_path: str = ONNX_EMBED_MODEL, tokenizer_path: str = ONNX_EMBED_TOKENIZER):
+        import numpy as np
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self._np = np
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = os.cpu_count() or 1
+        self._session = ort.InferenceSession(
+            model_path, sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = Tokenizer.from_file(tokenizer_path)
+        self._tokenizer.enable_truncation(max_length=512)
+
+    def _encode(self, texts: List[str]):
+        np = self._np
+        encs = self._tokenizer.encode_batch(texts)
+        max_len = max(len(e.ids) for e in encs)
+        input_ids = np.zeros((len(encs), max_len), dtype=np.int64)
+        attention_mask = np.zeros_like(input_ids)
+        for i, e in enumerate(encs):
+            input_ids[i, : len(e.ids)] = e.ids
+            attention_mask[i, : len(e.ids)] = e.attention_mask
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        hidden = self._session.run(None, feeds)[0]
+        # masked mean pooling + L2 normalization
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+class _BatchingEmbeddings:
+    """
+    Wraps an embeddings backend and coalesces concurrent embed_query() calls
+    into one embed_documents() batch. Callers enqueue their text and block on
+    an event; a daemon thread pops the first waiter, drains the queue for up
+    to `max_wait_ms`, then issues a single HTTP call for the whole batch.
+    A lone caller only ever waits for its own request (the drain window starts
+    after the first item arrives), so latency barely regresses at low load.
+    """
+
+    def __init__(self, inner, max_batch: int = EMBED_MAX_BATCH, max_wait_ms: int = EMBED_BATCH_WAIT_MS):
+        self._inner = inner
+        self._max_batch = max(1, max_batch)
+        self._max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # document batches are already batched by the caller; pass through
+        return self._inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        done = threading.Event()
+        slot: Dict[str, object] = {}
+        self._queue.put((text, done, slot))
+        done.wait()
+        if "error" in slot:
+            raise slot["error"]  # type: ignore[misc]
+        return slot["result"]  # type: ignore[return-value]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]  # block for the first waiter
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                vectors = self._inner.embed_documents([text for text, _, _ in batch])
+            except Exception as e:
+                for _, done, slot in batch:
+                    slot["error"] = e
+                    done.set()
+                continue
+            for (_, done, slot), vec in zip(batch, vectors):
+                slot["result"] = vec
+                done.set()
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
 
 def _build_embeddings():
-    if LLM_PROVIDER == "ollama":
-        return OllamaEmbeddings(model=OLLAMA_EMBED_MODEL)
-    return OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL)
+    if EMBED_PROVIDER == "local":
+        inner = LocalEmbeddings()
+    elif LLM_PROVIDER == "ollama":
+        inner = OllamaEmbeddings(model=OLLAMA_EMBED_MODEL)
+    else:
+        inner = OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL, chunk_size=EMBED_DOC_BATCH)
+    if EMBED_MAX_BATCH <= 1:
+        return inner
+    return _BatchingEmbeddings(inner)
 
 def _build_llm():
     if LLM_PROVIDER == "ollama":
         return ChatOllama(model=OLLAMA_MODEL, temperature=TEMPERATURE)
     return ChatOpenAI(model=OPENAI_MODEL, temperature=TEMPERATURE)
 
+def _citations_for(ctx_docs: List[Document]) -> List[Dict[str, str]]:
+    """
+    Build citation entries (title with page number, /api/files URL with a
+    #page=N anchor when available) for a list of context docs.
+    """
+    citations = []
+    for d in ctx_docs:
+        src = d.metadata.get("source", "") or ""
+        base = os.path.basename(src) or "source"
+
+        # Try to extract page number from metadata
+        page = d.metadata.get("page", d.metadata.get("page_number"))
+        title = f"{base} p.{page}" if page is not None else base
+
+        # Build URL with page reference if applicable
+        file_url = _file_to_url(src)
+        if page is not None:
+            file_url += f"#page={page}"
+
+        citations.append({
+            "title": title,
+            "url": file_url
+        })
+    return citations
+
+
+def _build_prompt(query: str, context: str) -> str:
+    return f"""You are a concise assistant that must answer using ONLY the provided context.
+        Conversation Priority Rules:
+- ALWAYS treat the most recent user message as the main question.
+- Only use earlier conversation history if the latest user message clearly depends on it.
+- Ignore old conversation topics that are unrelated to the latest question, even if they are very long.
+- Never allow previous topics to override or dominate the current question.
+If the latest user message asks for a list, fact, definition, or simple information, ignore all previous conversation that is not directly related.
+
+You may reason from context clues to interpret abbreviations, acronyms, or partial terms if their likely meaning can be clearly inferred from the text provided. 
+For example, if a repeated acronym appears near specific phrases, titles, or descriptions that indicate what it likely refers to, you may use that inferred meaning. 
+However, never use outside knowledge or external assumptions that are not supported by the context itself.
+
+Rules:
+- Ensure that the citation numbering you use ([1], [2], etc.) directly corresponds to the sources list that will be provided below.
+- If the context is insufficient, say so briefly including the phrase "sorry, we do not have enough information" and do not invent details.
+- If a meaning cannot be reasonably inferred, explicitly state that it is unclear.
+- If the question is not really a question, and it is a simple conversational input, feel free to respond with a conversational response and inform that your main purpose here is to answer information questions from the file base. 
+- When you do inform the users your main purpose and you are not responding with any of the information you got from the context. 
+- Encourage the user to ask you questions that is within the realm of your purpose and direct or redirect the conversation toward that, especially when you can't answer
+- When you do not have the answers to a question, respond with "sorry, we do not have enough information" and then invite the user to ask questions related to the topics found in the file base or the materials you have access to. Do not invent new topics or domains that are not supported by the context. Make sure you give examples of what topics are in the file base. Do not just tell the user to ask questions related to the topics found in the file base
+- If you are responding with infromation fom the context, you do not need to explain your purpose to the user
+- You may mention general topic categories only if they clearly appear in the retrieved context. For example, if many documents reference education or ministry, you may encourage questions in those areas. Otherwise, simply invite the user to ask another question without naming new topics.
+- if you are listing things, feel free to include \n at the end of each of the list items. so that it can be displayed to the user better visually
+- Only cite a source [n] if the text of that source directly contains the information you are presenting.
+- Do not assign citation numbers evenly or by count.
+- If the question or statement includes any form of curse words, gently tell the user to stop.
+- Refrain from using any form of contraction (for example, use "do not" instead of "don't", use "cannot" instead of "can't").
+- Note: The context may include only part of a numbered or sequential list.
+- If consecutive numbers or headings appear, continue listing them only if their full text is visible in the context.
+- Do not invent missing items beyond what is present.
+
+    Question:
+    {query}
+
+    Context:
+    {context}
+
+    Answer (use [n]-style citations inline where relevant):
+    """
+
+
+class SemanticCache:
+    """
+    Nearest-neighbor cache over query embeddings. Queries whose embedding
+    cosine similarity to a cached query clears `threshold` reuse that
+    answer without retrieval or an LLM call — catching rephrasings the
+    exact-match answer cache misses. Least-recently-used entries are
+    evicted once `max_size` is reached.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_size: int = SEMANTIC_CACHE_SIZE):
+        import numpy as np
+        self._np = np
+        self._threshold = threshold
+        self._max_size = max_size
+        self._vecs: List[Any] = []    # unit-norm float32 vectors
+        self._values: List[Any] = []  # parallel (answer, citations) entries
+        # answer() runs in worker threads; the pop/append pairs below must
+        # not interleave or the vector/value lists desynchronize
+        self._lock = threading.Lock()
+
+    def _unit(self, q_vec):
+        np = self._np
+        q = np.asarray(q_vec, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        return q / norm if norm else q
+
+    def lookup(self, q_vec):
+        np = self._np
+        q = self._unit(q_vec)
+        with self._lock:
+            if not self._vecs:
+                return None
+            sims = np.vstack(self._vecs) @ q
+            i = int(sims.argmax())
+            if sims[i] < self._threshold:
+                return None
+            # refresh recency on hit
+            self._vecs.append(self._vecs.pop(i))
+            self._values.append(self._values.pop(i))
+            return self._values[-1]
+
+    def insert(self, q_vec, value) -> None:
+        vec = self._unit(q_vec)
+        with self._lock:
+            self._vecs.append(vec)
+            self._values.append(value)
+            if len(self._vecs) > self._max_size:
+                self._vecs.pop(0)
+                self._values.pop(0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vecs.clear()
+            self._values.clear()
+
+
 @dataclass
 class RagPipeline:
     llm: any
     vectordb: Chroma
+    embeddings: Any = None
+    # LRU of normalized query -> (answer, citations); avoids re-running the
+    # whole embed + retrieve + LLM pipeline for repeated questions
+    _answer_cache: "OrderedDict" = field(default_factory=OrderedDict)
+    # as_retriever() builds and validates a fresh VectorStoreRetriever each
+    # call; reuse one per k since the config never changes between reloads
+    _retrievers: Dict[int, Any] = field(default_factory=dict)
+    # similarity cache over query embeddings for near-duplicate questions
+    _semantic_cache: SemanticCache = field(default_factory=SemanticCache)
+    # guards _answer_cache: answer() runs in worker threads and an insert's
+    # eviction can race another thread's get/move_to_end
+    _cache_lock: Any = field(default_factory=threading.Lock)
 
     @classmethod
     def from_disk(cls) -> "RagPipeline":
         # (re)create index if missing; otherwise open persisted
         embeddings = _build_embeddings()
 
-        if not os.path.exists(CHROMA_DIR) or not os.listdir(CHROMA_DIR):
-            os.makedirs(CHROMA_DIR, exist_ok=True)
+        fresh = not os.path.exists(CHROMA_DIR) or not os.listdir(CHROMA_DIR)
+        os.makedirs(CHROMA_DIR, exist_ok=True)
+        vectordb = Chroma(
+            embedding_function=embeddings,
+            persist_directory=CHROMA_DIR,
+            collection_name="site-docs",
+        )
+        if fresh:
             base_docs = _load_docs_from_dir(DOCS_DIR)
             chunks = _split(base_docs)
-            vectordb = Chroma.from_documents(
-                documents=chunks,
-                embedding=embeddings,
-                persist_directory=CHROMA_DIR,
-                collection_name="site-docs",
-            )
-        else:
-            vectordb = Chroma(
-                embedding_function=embeddings,
-                persist_directory=CHROMA_DIR,
-                collection_name="site-docs",
-            )
+            ids = [uuid.uuid4().hex for _ in chunks]
+            _index_chunks(vectordb, embeddings, chunks, ids)
+            _save_manifest(_build_manifest(chunks, ids))
         llm = _build_llm()
-        return cls(llm=llm, vectordb=vectordb)
+        return cls(llm=llm, vectordb=vectordb, embeddings=embeddings)
+
+    def reload(self, full: bool = False):
+        """
+        Re-sync the index with DOCS_DIR. By default only files whose mtime
+        changed (or that were added/removed) are re-split and re-embedded;
+        pass full=True to drop and rebuild the whole collection.
+        """
+        manifest = _load_manifest()
+        if full or not manifest:
+            self._full_rebuild()
+            with self._cache_lock:
+                self._answer_cache.clear()
+            self._semantic_cache.clear()
+            return
+
+        current = {}
+        for fp in _supported_files(DOCS_DIR):
+            try:
+                current[fp] = os.path.getmtime(fp)
+            except OSError:
+                continue
 
-    def reload(self):
+        changed = [fp for fp, mtime in current.items()
+                   if fp not in manifest or manifest[fp].get("mtime") != mtime]
+        removed = [fp for fp in manifest if fp not in current]
+
+        for fp in removed:
+            old_ids = manifest.pop(fp).get("ids") or []
+            if old_ids:
+                self.vectordb.delete(ids=old_ids)
+
+        for fp in changed:
+            old = manifest.pop(fp, None)
+            if old and old.get("ids"):
+                self.vectordb.delete(ids=old["ids"])
+            chunks = _split(_load_one_file(fp))
+            ids = [uuid.uuid4().hex for _ in chunks]
+            _index_chunks(self.vectordb, self.embeddings, chunks, ids)
+            manifest[fp] = {"mtime": current[fp], "ids": ids}
+
+        _save_manifest(manifest)
+        # cached answers may cite documents that no longer exist
+        with self._cache_lock:
+            self._answer_cache.clear()
+        self._semantic_cache.clear()
+
+    def _full_rebuild(self):
         # drop + rebuild (simple approach)
         try:
             self.vectordb.delete_collection()
@@ -180,106 +677,182 @@ class RagPipeline:
         os.makedirs(CHROMA_DIR, exist_ok=True)
         base_docs = _load_docs_from_dir(DOCS_DIR)
         chunks = _split(base_docs)
-        self.vectordb = Chroma.from_documents(
-            documents=chunks,
-            embedding=embeddings,
+        ids = [uuid.uuid4().hex for _ in chunks]
+        self.vectordb = Chroma(
+            embedding_function=embeddings,
             persist_directory=CHROMA_DIR,
             collection_name="site-docs",
         )
-
-    def retrieve(self, query: str, k: int = TOP_K) -> List[Document]:
+        self.embeddings = embeddings
+        _index_chunks(self.vectordb, embeddings, chunks, ids)
+        # cached retrievers are bound to the old vectordb object
+        self._retrievers.clear()
+        _save_manifest(_build_manifest(chunks, ids))
+
+    def retrieve(self, query: str, k: int = TOP_K,
+                 q_vec: Optional[List[float]] = None) -> List[Document]:
         """
         Universal retrieval that:
         • uses high-recall initial search
         • adds neighbor chunks from same source (context stitching)
         • applies generic junk + footnote filtering
         • prefers majority source to stabilize multi-page topics
-        """
-        FOOTNOTE_PAT = re.compile(
-            r"(?:\bwww\.[^\s]+|\bhttps?://[^\s]+|\baccessed\s+\w+|\bvol\.\s*\d+|\bp\.\s*\d+|\bdoi:)",
-            re.I
-        )
 
+        When q_vec (an already-computed query embedding) is given, the wide
+        search runs by vector so the query is never re-embedded.
+        """
         # Step 1 – Wide recall pool
-        retriever = self.vectordb.as_retriever(search_kwargs={"k": k * 4})
-        raw = retriever.invoke(query)
+        pool_k = k * 4
+        if q_vec is not None:
+            raw = self.vectordb.similarity_search_by_vector(q_vec, k=pool_k)
+        else:
+            retriever = self._retrievers.get(pool_k)
+            if retriever is None:
+                retriever = self._retrievers.setdefault(
+                    pool_k, self.vectordb.as_retriever(search_kwargs={"k": pool_k})
+                )
+            raw = retriever.invoke(query)
 
-        # Step 2 – Generic cleanup
-        cleaned = []
+        # Step 2 – Generic cleanup, fused with candidate construction: each
+        # survivor becomes a _Candidate carrying its lowercase text, basename
+        # and page so the later stages never recompute them
+        cands: List[_Candidate] = []
         for d in raw:
             txt = (d.page_content or "").strip()
-            low = txt.lower()
             if not txt or len(txt) < 60:
                 continue
-            if re.search(r"(table of contents|copyright|all rights reserved|printed on)", low):
-                continue
-            if re.fullmatch(r"\d+", low):
+            low = txt.lower()
+            if low.isdigit():  # all-digit chunk (page numbers, tables of figures)
                 continue
-            if len(txt) < 500 and FOOTNOTE_PAT.search(low):
+            # one regex pass per doc: footnote markers only disqualify short
+            # chunks, so long ones skip that half of the alternation
+            if len(txt) < 500:
+                if _JUNK_OR_FOOTNOTE_PAT.search(low):
+                    continue
+            elif _JUNK_PAT.search(low):
                 continue
-            cleaned.append(d)
-
-        if not cleaned:
+            meta = d.metadata or {}
+            cands.append(_Candidate(
+                doc=d,
+                low=low,
+                base=os.path.basename(meta.get("source", "") or ""),
+                page=meta.get("page", meta.get("page_number")),
+            ))
+
+        if not cands:
             return raw[:k]
 
-        # Step 3 – Keyword overlap
+        # Step 3 – Keyword overlap, scored once per candidate so the >=1
+        # fallback never rescans the texts
         kws = _query_keywords(query)
+        pool = cands
         if kws:
-            overlap = [d for d in cleaned if _hits(d.page_content, kws) >= 2]
+            count_hits = _keyword_counter(kws)
+            for c in cands:
+                c.score = count_hits(c.low)
+            overlap = [c for c in cands if c.score >= 2]
             if not overlap:
-                overlap = [d for d in cleaned if _hits(d.page_content, kws) >= 1]
-            pool = overlap if overlap else cleaned
-        else:
-            pool = cleaned
+                overlap = [c for c in cands if c.score >= 1]
+            if overlap:
+                pool = overlap
 
         # Step 4 – Add neighbors from same source (context stitching)
-        neighbors: List[Document] = []
+        wanted: List[Tuple[str, int]] = []
         seen = set()
-        for d in pool[: k * 2]:
-            src = d.metadata.get("source")
+        for c in pool[: k * 2]:
+            src = c.doc.metadata.get("source")
             if not src or src in seen:
                 continue
             seen.add(src)
-            page = d.metadata.get("page") or d.metadata.get("page_number")
-            if page is not None:
-                for adj in (page - 1, page + 1):
-                    key = {"source": src, "page": adj}
-                    # Use the persistent collection to pull that neighbor if present
-                    try:
-                        neighbor_docs = self.vectordb._collection.get(
-                            where=key,
-                            limit=1
-                        )
-                        if neighbor_docs and neighbor_docs["documents"]:
-                            ndoc = Document(
-                                page_content=neighbor_docs["documents"][0],
-                                metadata={"source": src, "page": adj}
-                            )
-                            neighbors.append(ndoc)
-                    except Exception:
-                        continue
-        pool.extend(neighbors)
+            if c.page is not None:
+                wanted.append((src, c.page - 1))
+                wanted.append((src, c.page + 1))
+
+        if wanted:
+            # one collection query for all neighbors instead of a get() per
+            # (source, page) pair; over-fetch by source+page sets, then keep
+            # only the exact pairs we asked for
+            try:
+                got = self.vectordb._collection.get(
+                    where={"$and": [
+                        {"source": {"$in": sorted({s for s, _ in wanted})}},
+                        {"page": {"$in": sorted({p for _, p in wanted})}},
+                    ]},
+                    include=["documents", "metadatas"],
+                )
+                by_key = {
+                    (m.get("source"), m.get("page")): doc
+                    for m, doc in zip(got["metadatas"], got["documents"])
+                }
+                for src, adj in wanted:
+                    content = by_key.get((src, adj))
+                    if content:
+                        pool.append(_Candidate(
+                            doc=Document(
+                                page_content=content,
+                                metadata={"source": src, "page": adj},
+                            ),
+                            low=content.lower(),
+                            base=os.path.basename(src),
+                            page=adj,
+                        ))
+            except Exception:
+                pass
 
         # Step 5 – Majority source preference
-        maj = _majority_source(pool)
+        maj = _majority_source(c.base for c in pool)
         if maj:
-            primary = [d for d in pool if _basename(d) == maj]
-            others  = [d for d in pool if _basename(d) != maj]
+            primary = [c for c in pool if c.base == maj]
+            others  = [c for c in pool if c.base != maj]
             if len(primary) >= max(2, len(pool) // 2):
                 pool = primary + others[:max(0, k - len(primary))]
 
         # Step 6 – Return final k (after dedup)
-        unique = []
+        unique: List[Document] = []
         seen_keys = set()
-        for d in pool:
-            key = (_basename(d), d.metadata.get("page"))
+        for c in pool:
+            key = (c.base, c.page)
             if key not in seen_keys:
                 seen_keys.add(key)
-                unique.append(d)
+                unique.append(c.doc)
 
         return unique[:k]
 
 
+    def iterative_retrieve(self, query: str, k: int = TOP_K, max_passes: int = 3,
+                           q_vec: Optional[List[float]] = None) -> List[Document]:
+        """
+        Attempt multi-pass retrieval when the first batch might be incomplete.
+        Each pass excludes previously seen sources/pages.
+        """
+        all_docs = []
+        seen_keys = set()
+
+        for pass_i in range(max_passes):
+            # Retrieve as usual
+            new_docs = self.retrieve(query, k=k, q_vec=q_vec)
+
+            # Filter out duplicates (same source + page)
+            unique = []
+            for d in new_docs:
+                key = (d.metadata.get("source"), d.metadata.get("page"))
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    unique.append(d)
+
+            # Stop if we are not finding anything new
+            if not unique:
+                break
+
+            all_docs.extend(unique)
+
+            # 🔍 If the retrieved docs already cover many unique sections (e.g. 10+ chunks), stop early
+            if len(all_docs) >= k * 2:
+                break
+
+        # Limit to k final documents (you can choose len(all_docs) if you prefer to feed all)
+        return all_docs[:k]
+
     def _expand_adjacent_pages(self, docs: List[Document], window: int = 2) -> List[Document]:
         """
         Expand context by adding nearby pages from the same PDF when multiple
@@ -289,20 +862,41 @@ class RagPipeline:
         if not docs:
             return docs
 
+        # page expansion only makes sense for paginated sources (PDFs); for a
+        # pure md/html corpus nothing below can match, so skip the collection
+        # query entirely
+        if not any(d.metadata.get("page") is not None for d in docs):
+            return docs
+
         expanded = list(docs)
         sources = {d.metadata.get("source") for d in docs if d.metadata.get("source")}
-        all_meta = self.vectordb._collection.get(include=["metadatas", "documents"])
+        if not sources:
+            return expanded
+
+        # fetch only chunks from the sources at hand instead of materializing
+        # the entire collection (which grows with the corpus) on every answer
+        try:
+            got = self.vectordb._collection.get(
+                where={"source": {"$in": sorted(sources)}},
+                include=["metadatas", "documents"],
+            )
+        except Exception:
+            return expanded
+
+        per_src: Dict[str, List[Tuple[int, str, str]]] = {}
+        for m, doc in zip(got["metadatas"], got["documents"]):
+            if "page" in m:
+                per_src.setdefault(m.get("source"), []).append((m.get("page"), m.get("source"), doc))
 
         for src in sources:
-            # Extract all pages for this source from the index
-            entries = [
-                (m.get("page"), m.get("source"), d)
-                for m, d in zip(all_meta["metadatas"], all_meta["documents"])
-                if m.get("source") == src and "page" in m
-            ]
+            # All pages for this source from the index
+            entries = per_src.get(src, [])
 
             # Get current pages already retrieved
-            current_pages = [d.metadata.get("page") for d in docs if d.metadata.get("source") == src]
+            current_pages = [
+                d.metadata.get("page") for d in docs
+                if d.metadata.get("source") == src and d.metadata.get("page") is not None
+            ]
             if not current_pages:
                 continue
 
@@ -318,21 +912,79 @@ class RagPipeline:
         return expanded
 
 
-    def answer(self, query: str, k: int = TOP_K) -> Tuple[str, List[Dict[str, str]]]:
-        ctx_docs = iterative_retrieve(self, query, k=k, max_passes=3)
-        print(f"⚙️ Running LLM for query: {query}, retrieved {len(ctx_docs)} context docs")
+    def _gather_context(self, query: str, k: int = TOP_K,
+                        q_vec: Optional[List[float]] = None) -> List[Document]:
+        """
+        Shared retrieval front half: iterative retrieval, adjacent-page
+        expansion, a soft junk filter, and page-order sorting.
+        """
+        ctx_docs = self.iterative_retrieve(query, k=k, max_passes=3, q_vec=q_vec)
         ctx_docs = self._expand_adjacent_pages(ctx_docs, window=2)
         # Optional minor quality filter to drop obviously irrelevant junk
         ctx_docs = [d for d in ctx_docs if len(d.page_content.split()) > 10]
         if not ctx_docs:
-            ctx_docs = self.retrieve(query, k=k)  # retry without the soft filter if emptied
-        
+            ctx_docs = self.retrieve(query, k=k, q_vec=q_vec)  # retry without the soft filter if emptied
+
         # Sort context docs by page number (if available) to preserve logical order
         ctx_docs.sort(key=lambda d: d.metadata.get("page", d.metadata.get("page_number", 0)))
-        
+        return ctx_docs
+
+    def stream_answer(self, query: str, k: int = TOP_K):
+        """
+        Generator variant of answer() for SSE. Yields ("delta", token_text)
+        as the LLM produces tokens, then a final ("citations", citations)
+        event. Skips answer()'s retry and renumbering post-processing —
+        streaming trades that polish for time-to-first-token.
+        """
+        ctx_docs = self._gather_context(query, k)
+        print(f"⚙️ Streaming LLM for query: {query}, retrieved {len(ctx_docs)} context docs")
+
+        context = "\n\n".join(
+            f"[{i+1}] {d.page_content}" for i, d in enumerate(ctx_docs)
+        )
+        citations = _citations_for(ctx_docs)
+        prompt = _build_prompt(query, context)
+
+        for chunk in self.llm.stream(prompt):
+            piece = getattr(chunk, "content", None)
+            if piece:
+                yield "delta", piece
+
+        yield "citations", citations
+
+    def answer(self, query: str, k: int = TOP_K) -> Tuple[str, List[Dict[str, str]]]:
+        cache_key = (_normalize(query), k)
+        if ANSWER_CACHE_SIZE:
+            with self._cache_lock:
+                cached = self._answer_cache.get(cache_key)
+                if cached is not None:
+                    self._answer_cache.move_to_end(cache_key)
+            if cached is not None:
+                text, citations = cached
+                return text, [dict(c) for c in citations]
+
+        # semantic near-duplicate check: embed once, reuse for the lookup
+        q_vec = None
+        if SEMANTIC_CACHE_SIZE and self.embeddings is not None:
+            try:
+                q_vec = self.embeddings.embed_query(query)
+            except Exception:
+                q_vec = None
+            if q_vec is not None:
+                hit = self._semantic_cache.lookup(q_vec)
+                if hit is not None:
+                    text, citations = hit
+                    return text, [dict(c) for c in citations]
+
+        # the embedding computed for the cache lookup doubles as the search
+        # vector, so a cache miss costs no extra embed_query round trip
+        ctx_docs = self._gather_context(query, k, q_vec=q_vec)
+        print(f"⚙️ Running LLM for query: {query}, retrieved {len(ctx_docs)} context docs")
+
         # Build the numbered context block that the LLM will cite as [n]
+        # (chunks are stripped at index time, so this is a single join pass)
         context = "\n\n".join(
-            f"[{i+1}] {d.page_content.strip()}" for i, d in enumerate(ctx_docs)
+            f"[{i+1}] {d.page_content}" for i, d in enumerate(ctx_docs)
         )
 
         # --- Save context to local file ---
@@ -349,143 +1001,70 @@ class RagPipeline:
 
 
         # Build richer citations: include page numbers and add #page=N to URLs
-        citations = []
-        for d in ctx_docs:
-            src = d.metadata.get("source", "") or ""
-            base = os.path.basename(src) or "source"
-
-            # Try to extract page number from metadata
-            page = d.metadata.get("page", d.metadata.get("page_number"))
-            title = f"{base} p.{page}" if page is not None else base
-
-            # Build URL with page reference if applicable
-            file_url = _file_to_url(src)
-            if page is not None:
-                file_url += f"#page={page}"
-
-            citations.append({
-                "title": title,
-                "url": file_url
-            })
+        citations = _citations_for(ctx_docs)
 
         # Clean, explicit prompt to avoid hallucination
-        prompt = f"""You are a concise assistant that must answer using ONLY the provided context.
-        Conversation Priority Rules:
-- ALWAYS treat the most recent user message as the main question.
-- Only use earlier conversation history if the latest user message clearly depends on it.
-- Ignore old conversation topics that are unrelated to the latest question, even if they are very long.
-- Never allow previous topics to override or dominate the current question.
-If the latest user message asks for a list, fact, definition, or simple information, ignore all previous conversation that is not directly related.
-
-You may reason from context clues to interpret abbreviations, acronyms, or partial terms if their likely meaning can be clearly inferred from the text provided. 
-For example, if a repeated acronym appears near specific phrases, titles, or descriptions that indicate what it likely refers to, you may use that inferred meaning. 
-However, never use outside knowledge or external assumptions that are not supported by the context itself.
-
-Rules:
-- Ensure that the citation numbering you use ([1], [2], etc.) directly corresponds to the sources list that will be provided below.
-- If the context is insufficient, say so briefly including the phrase "sorry, we do not have enough information" and do not invent details.
-- If a meaning cannot be reasonably inferred, explicitly state that it is unclear.
-- If the question is not really a question, and it is a simple conversational input, feel free to respond with a conversational response and inform that your main purpose here is to answer information questions from the file base. 
-- When you do inform the users your main purpose and you are not responding with any of the information you got from the context. 
-- Encourage the user to ask you questions that is within the realm of your purpose and direct or redirect the conversation toward that, especially when you can't answer
-- When you do not have the answers to a question, respond with "sorry, we do not have enough information" and then invite the user to ask questions related to the topics found in the file base or the materials you have access to. Do not invent new topics or domains that are not supported by the context. Make sure you give examples of what topics are in the file base. Do not just tell the user to ask questions related to the topics found in the file base
-- If you are responding with infromation fom the context, you do not need to explain your purpose to the user
-- You may mention general topic categories only if they clearly appear in the retrieved context. For example, if many documents reference education or ministry, you may encourage questions in those areas. Otherwise, simply invite the user to ask another question without naming new topics.
-- if you are listing things, feel free to include \n at the end of each of the list items. so that it can be displayed to the user better visually
-- Only cite a source [n] if the text of that source directly contains the information you are presenting.
-- Do not assign citation numbers evenly or by count.
-- If the question or statement includes any form of curse words, gently tell the user to stop.
-- Refrain from using any form of contraction (for example, use "do not" instead of "don't", use "cannot" instead of "can't").
-- Note: The context may include only part of a numbered or sequential list.
-- If consecutive numbers or headings appear, continue listing them only if their full text is visible in the context.
-- Do not invent missing items beyond what is present.
-
-    Question:
-    {query}
-
-    Context:
-    {context}
-
-    Answer (use [n]-style citations inline where relevant):
-    """
+        prompt = _build_prompt(query, context)
 
         # Invoke the LLM
         resp = self.llm.invoke(prompt)
         text = resp.content if hasattr(resp, "content") else str(resp)
 
         # --- Detect incomplete numbered list ---
-        if re.search(r"(?m)^\d+\.", text):
-            numbers = [int(n) for n in re.findall(r"(?m)^(\d+)\.", text)]
+        incomplete_list = False
+        if _NUMBERED_ITEM_PAT.search(text):
+            numbers = [int(n) for n in _NUMBERED_ITEM_PAT.findall(text)]
             item_count = len(numbers)
             unique_count = len(set(numbers))
-            expected_count = re.search(r"\b(\d{1,2})\b.*(truth|commandment|beatitude|article|tenet)", query, re.I)
+            expected_count = _EXPECTED_COUNT_PAT.search(query)
 
             if expected_count and unique_count < int(expected_count.group(1)):
                 print(f"⚙️ Detected incomplete or partial list ({unique_count}/{expected_count.group(1)}). Retrying...")
-                normalized_text = "list may not be complete"
-        
+                incomplete_list = True
+
         # --- Auto-retry if the AI says it does not have enough information ---
-        refusal_phrases = [
-            "sorry, we do not have enough information",
-            "insufficient context",
-            "not enough information",
-            "cannot answer",
-            "no relevant information",
-            "list may not be complete",              
-            "appears to be truncated",               
-            "context does not include all items",
-        ]
-
-        # normalize text early
-        normalized_text = text.lower().strip()
-        if any(p in normalized_text for p in refusal_phrases):
+        if incomplete_list or _RETRY_TRIGGER_PAT.search(text):
             print("⚙️ Detected incomplete answer. Running second retrieval pass...")
 
             seen_keys = {(d.metadata.get("source"), d.metadata.get("page")) for d in ctx_docs}
+
+            # one wide pass at k*3 covers what the old two escalating passes
+            # (k*2 then k*3) found, without a second vector search
             added_docs = []
-            all_attempted = list(ctx_docs)
-
-            # up to 2 retry passes
-            for pass_i in range(2):
-                new_docs = self.retrieve(query, k=k * (pass_i + 2))
-                unique_new = []
-                for d in new_docs:
-                    key = (d.metadata.get("source"), d.metadata.get("page"))
-                    if key not in seen_keys:
-                        seen_keys.add(key)
-                        unique_new.append(d)
-                if not unique_new:
-                    break  # no new context found
-                all_attempted.extend(unique_new)
-                added_docs.extend(unique_new)
-
-                # stop early if we have new pages or longer context
-                if len(all_attempted) >= len(ctx_docs) + 2:
-                    break
+            for d in self.retrieve(query, k=k * 3, q_vec=q_vec):
+                key = (d.metadata.get("source"), d.metadata.get("page"))
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    added_docs.append(d)
+            all_attempted = list(ctx_docs) + added_docs
 
             if added_docs:
                 ctx_docs = all_attempted
                 # rebuild the context string
                 context_retry = "\n\n".join(
-                    f"[{i+1}] {d.page_content.strip()}" for i, d in enumerate(ctx_docs)
+                    f"[{i+1}] {d.page_content}" for i, d in enumerate(ctx_docs)
                 )
 
-                # log retry details
-                with open("context.txt", "a", encoding="utf-8") as f:
-                    f.write("\n⚙️ Second retrieval pass triggered due to incomplete response.\n")
-                    f.write(f"Added {len(added_docs)} new docs.\n")
-                    for d in added_docs:
-                        f.write(f"  - {d.metadata.get('source')} p.{d.metadata.get('page')}\n")
-                    f.write("📄 Expanded Context Sent to Model:\n")
-                    f.write(context_retry)
-                    f.write("\n" + "=" * 80 + "\n\n")
-
-                # rebuild the prompt with the expanded context
-                retry_prompt = f"""{prompt}
-
-        Additional context (second retrieval pass):
-        {context_retry}
-        """
+                # log retry details (handed off to the debug-log thread as a
+                # single payload, keeping file I/O off the request path)
+                lines = [
+                    "\n⚙️ Second retrieval pass triggered due to incomplete response.\n",
+                    f"Added {len(added_docs)} new docs.\n",
+                ]
+                lines.extend(
+                    f"  - {d.metadata.get('source')} p.{d.metadata.get('page')}\n"
+                    for d in added_docs
+                )
+                lines.append("📄 Expanded Context Sent to Model:\n")
+                lines.append(context_retry)
+                lines.append("\n" + "=" * 80 + "\n\n")
+                _debug_log("".join(lines))
+
+                # rebuild the prompt from scratch with the merged context so
+                # the model sees one numbered block instead of the original
+                # context twice; citations follow the new numbering
+                retry_prompt = _build_prompt(query, context_retry)
+                citations = _citations_for(ctx_docs)
 
                 try:
                     resp_retry = self.llm.invoke(retry_prompt)
@@ -497,7 +1076,8 @@ Rules:
 
         
         # Extract which sources were actually cited in the text
-        used_indices = {int(n) for n in re.findall(r"\[(\d+)\]", text)}
+        # (finditer avoids materializing the full match list; we only need the set)
+        used_indices = {int(m.group(1)) for m in _CITE_PAT.finditer(text)}
         if used_indices:
             citations = [c for i, c in enumerate(citations, start=1) if i in used_indices]
             # remove duplicates and keep only valid indices
@@ -512,7 +1092,7 @@ Rules:
         # print("AI Response:", text)
         
         # --- Ensure citation numbering matches actual available sources ---
-        found_indices = sorted({int(n) for n in re.findall(r"\[(\d+)\]", text)})
+        found_indices = sorted({int(m.group(1)) for m in _CITE_PAT.finditer(text)})
 
         # --- Deduplicate and renumber citations cleanly ---
         if citations:
@@ -527,7 +1107,7 @@ Rules:
             citations = unique_citations
 
             # 2) Extract unique [n] markers from text
-            found_indices = sorted({int(n) for n in re.findall(r"\[(\d+)\]", text)})
+            found_indices = sorted({int(m.group(1)) for m in _CITE_PAT.finditer(text)})
 
             # 3) Rebuild mapping 1→N based on available citations
             max_n = min(len(found_indices), len(citations))
@@ -538,60 +1118,65 @@ Rules:
                 return f"[{mapping.get(old, len(mapping))}]"
 
             # 4) Apply clean numbering
-            text = re.sub(r"\[(\d+)\]", _renumber_final, text)
+            text = _CITE_PAT.sub(_renumber_final, text)
 
             # 5) Collapse duplicate inline markers like [5][5][5]
-            text = re.sub(r"(\[\d+\])(?:\1)+", r"\1", text)
+            text = _DUP_CITE_PAT.sub(r"\1", text)
 
             # 6) Trim citation list to match remapped range
             citations = citations[: len(mapping)]
 
-        # detect refusal phrases
-        refusal_detected = any(
-            phrase in normalized_text
-            for phrase in [
-                "cannot answer",
-                "insufficient context",
-                "not enough information",
-                "no relevant information",
-                "based on the provided context i cannot",
-                "sorry, we do not have enough information",
-                "my main purpose here is to answer information questions from the file base",
-            ]
-        )
+        # detect refusal phrases (one case-insensitive pass, no lowercased copy)
+        refusal_detected = bool(_REFUSAL_PAT.search(text))
 
         # detect factual content or citation markers
-        has_citations = bool(re.search(r"\[\d+\]", text))
-        has_factual_phrases = bool(re.search(r"(\bthe\b|\d+\.|•|- )", text, flags=re.I))
+        has_citations = bool(_CITE_PAT.search(text))
+        has_factual_phrases = bool(_FACTUAL_PAT.search(text))
 
         # 🧠 enhanced logic
         # hide citations if the answer is purely a refusal, even if it includes stray [1]
         if refusal_detected and not has_factual_phrases:
             # Remove stray inline [n]
-            text = re.sub(r"\[\d+\]", "", text)
+            text = _CITE_PAT.sub("", text)
             citations = []
 
         # If model did not include any [n], auto-append citations at the end of relevant sentences
-        if not re.search(r"\[\d+\]", text) and citations:
+        if not _CITE_PAT.search(text) and citations:
             # Split text into sentences
-            sentences = re.split(r'(?<=[.!?])\s+', text.strip())
+            sentences = _SENT_SPLIT_PAT.split(text.strip())
 
-            # Attach citations evenly across sentences that seem factual (non-apology)
-            factual_sentences = [s for s in sentences if not re.search(r"sorry|cannot|insufficient|not enough", s, re.I)]
+            # Attach citations evenly across sentences that seem factual
+            # (non-apology); work on positions so repeated sentences don't
+            # resolve to the first occurrence via list.index
+            factual_idx = [
+                i for i, s in enumerate(sentences) if not _APOLOGY_PAT.search(s)
+            ]
 
-            for i, s in enumerate(factual_sentences):
-                idx = i % len(citations)  # cycle through citations if fewer than sentences
-                sentences[sentences.index(s)] = s.strip() + f" [{idx+1}]"
+            for n, i in enumerate(factual_idx):
+                idx = n % len(citations)  # cycle through citations if fewer than sentences
+                sentences[i] = sentences[i].strip() + f" [{idx+1}]"
 
             text = " ".join(sentences)
 
         print("⚙️  Retrieved docs:", len(ctx_docs), "| Citations prepared:", len(citations))
-        print("⚙️  Found inline markers:", re.findall(r"\[\d+\]", text))
+        print("⚙️  Found inline markers:", _CITE_PAT.findall(text))
+
+        if ANSWER_CACHE_SIZE:
+            with self._cache_lock:
+                self._answer_cache[cache_key] = (text, [dict(c) for c in citations])
+                while len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                    self._answer_cache.popitem(last=False)
+        if q_vec is not None:
+            self._semantic_cache.insert(q_vec, (text, [dict(c) for c in citations]))
 
         return text, citations
 
 
 
+# _API_BASE = os.getenv("API_BASE", "http://localhost:8000").rstrip("/")
+_API_BASE = os.getenv("API_BASE", "https://api.chat.pathway.training").rstrip("/")
+
+@lru_cache(maxsize=4096)
 def _file_to_url(src: str) -> str:
     """
     Converts a local file path to a fully qualified /api/files URL.
@@ -599,6 +1184,4 @@ def _file_to_url(src: str) -> str:
     """
     base = os.path.basename(src)
     safe_base = quote(base, safe="#?()[]!$&',;=:@")  # allow useful URL chars
-    # api_base = os.getenv("API_BASE", "http://localhost:8000").rstrip("/")
-    api_base = os.getenv("API_BASE", "https://api.chat.pathway.training").rstrip("/")
-    return f"{api_base}/api/files/{safe_base}"
\ No newline at end of file
+    return f"{_API_BASE}/api/files/{safe_base}"
\ No newline at end of file